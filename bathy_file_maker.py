@@ -3,11 +3,13 @@ import requests
 import numpy as np
 from osgeo import gdal
 from osgeo import osr
+from si3dInputs import cleanBathy4si3d, smoothBathy4si3d
 
 
 class BathyFileMaker(object):
     """Used to create a bathymetry file for SI3D."""
-    def __init__(self, name='', dem=None, shoreline_shp=None, wse=None, out_dir=os.getcwd(), **kwargs):
+    def __init__(self, name='', dem=None, shoreline_shp=None, wse=None, out_dir=os.getcwd(), clean=False, keep=1,
+                 channel_rule=None, max_slope=None, rx0=None, **kwargs):
         """
         :param name: Name for the domain bathymetry, copied to SI3D bathy file header.
         :type name: str
@@ -23,6 +25,19 @@ class BathyFileMaker(object):
         :type wse: float
         :param out_dir: output directory, default = working directory
         :type out_dir: str
+        :param clean: (optional) remove isolated wet cells (puddles, single cell inlets) left by the clipped DEM.
+        :type clean: bool
+        :param keep: (optional) number of connected water regions kept by the cleanup starting from the largest one
+                     (default 1, the main basin), or list of (row, col) cells whose regions are kept.
+        :type keep: int or list
+        :param channel_rule: (optional) 'deadend' or 'width1', removal rule for one cell wide features during cleanup.
+                             See si3dInputs.cleanBathy4si3d.
+        :type channel_rule: str
+        :param max_slope: (optional) maximum bottom slope |dh|/dx (m/m). Steeper slopes are smoothed conserving the
+                          basin volume and the wet/dry mask. See si3dInputs.smoothBathy4si3d.
+        :type max_slope: float
+        :param rx0: (optional) maximum slope parameter |h1-h2|/(h1+h2) between neighbouring cells.
+        :type rx0: float
         :param kwargs:
 
         TODO:
@@ -33,6 +48,13 @@ class BathyFileMaker(object):
         self.shoreline_shp = shoreline_shp
         self.wse = wse
         self.out_dir = out_dir
+        self.clean = clean
+        self.keep = keep
+        self.channel_rule = channel_rule
+        self.clean_report = None
+        self.max_slope = max_slope
+        self.rx0 = rx0
+        self.smooth_report = None
         self.kwargs = kwargs
         # use name of DEM raster if no name is given
         self.dem_name = os.path.basename(dem).split('.')[0]
@@ -143,6 +165,16 @@ class BathyFileMaker(object):
         # convert m to dm
         print("Converting depths to dm...")
         arr = np.where(arr != -99, arr * 10, -99)
+        # remove isolated wet cells (if applicable)
+        if self.clean:
+            print("Removing isolated wet cells...")
+            arr, self.clean_report = cleanBathy4si3d(arr, self.keep, self.channel_rule)
+        # limit bottom slopes (if applicable)
+        if self.max_slope is not None or self.rx0 is not None:
+            print("Smoothing steep slopes...")
+            arr, self.smooth_report = smoothBathy4si3d(arr, abs(self.cell_size), self.max_slope, self.rx0)
+            if not self.smooth_report['converged']:
+                raise ValueError("ERROR: Bathymetry smoothing did not meet max_slope/rx0, relax the limits.")
         return arr
 
     def get_header(self):
@@ -0,0 +1,229 @@
+import os
+import struct
+import numpy as np
+import scipy.io as sio
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# MAT v5 data types (see MATLAB MAT-file format, Table 1-1)
+_MI_DTYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 9: 'f8', 12: 'i8', 13: 'u8'}
+_MI_MATRIX = 14
+# MAT v5 array classes that can be mapped straight to a numeric array
+_MX_DTYPES = {6: 'f8', 7: 'f4', 8: 'i1', 9: 'u1', 10: 'i2', 11: 'u2', 12: 'i4', 13: 'u4', 14: 'i8', 15: 'u8'}
+_MX_COMPLEX = 0x0800
+
+
+class MatLoader(object):
+    """Lazy reader for MATLAB .mat files (v5 and v7.3/HDF5) feeding the si3dInputs functions."""
+    def __init__(self, mat_file):
+        """
+        :param mat_file: Path to the input .mat file. Both v5 (default MATLAB "save") and v7.3 (HDF5) files are
+                         supported. Nothing but the file header and the variable directory is read on creation;
+                         variables are only read (or memory mapped) when requested through read().
+        :type mat_file: str
+        """
+        if not os.path.exists(mat_file):
+            raise FileNotFoundError(f"Cannot find input .mat file: {mat_file}")
+        self.mat_file = mat_file
+        self.is_hdf5 = self._check_hdf5()
+        # {name: (shape, class)} of the variables stored in the file
+        self.variables = self.get_variables()
+        # {name: (offset, shape, stored dtype, class dtype)} of the v5 variables that can be memory mapped
+        self._v5_offsets = {} if self.is_hdf5 else self._scan_v5()
+        # {name: array} of the compressed v5 variables already decompressed
+        self._cache = {}
+
+    def _check_hdf5(self):
+        """Check whether the .mat file is a v7.3 (HDF5) file."""
+        with open(self.mat_file, 'rb') as f:
+            header = f.read(128)
+        if header.startswith(b'MATLAB 7.3'):
+            if h5py is None:
+                raise IOError("ERROR: h5py is needed to read MATLAB v7.3 (HDF5) .mat files.")
+            return True
+        return False
+
+    def get_variables(self):
+        """Get the name, shape and class of every variable stored in the .mat file."""
+        if not self.is_hdf5:
+            return {name: (shape, cls) for name, shape, cls in sio.whosmat(self.mat_file)}
+        variables = {}
+        with h5py.File(self.mat_file, 'r') as f:
+            for name, item in f.items():
+                if name.startswith('#') or not isinstance(item, h5py.Dataset):
+                    continue
+                cls = item.attrs.get('MATLAB_class', b'')
+                cls = cls.decode() if isinstance(cls, bytes) else str(cls)
+                # MATLAB writes column-major arrays, HDF5 sees them transposed
+                variables[name] = (item.shape[::-1], cls)
+        return variables
+
+    def _scan_v5(self):
+        """
+        Walk the data element tags of a v5 file and record where the data of every uncompressed, real, numeric
+        variable starts so it can be memory mapped. Compressed variables (MATLAB's default) are skipped here and
+        read on demand through scipy.io.loadmat.
+        """
+        offsets = {}
+        size = os.path.getsize(self.mat_file)
+        with open(self.mat_file, 'rb') as f:
+            f.seek(126)
+            endian = '<' if f.read(2) == b'IM' else '>'
+            pos = 128
+            while pos + 8 <= size:
+                f.seek(pos)
+                mi_type, nbytes = struct.unpack(endian + 'II', f.read(8))
+                if mi_type == _MI_MATRIX:
+                    var = self._parse_v5_matrix(f, endian)
+                    if var is not None:
+                        offsets[var[0]] = var[1:]
+                # data elements are padded to 8 bytes (compressed ones are not)
+                pos += 8 + nbytes + (-nbytes % 8 if mi_type == _MI_MATRIX else 0)
+        return offsets
+
+    @staticmethod
+    def _read_v5_element(f, endian):
+        """Read a data sub-element tag, returns (type, nbytes, small) where small marks the 4-byte packed format."""
+        tag = struct.unpack(endian + 'I', f.read(4))[0]
+        if tag >> 16:
+            return tag & 0xFFFF, tag >> 16, True
+        return tag, struct.unpack(endian + 'I', f.read(4))[0], False
+
+    def _parse_v5_matrix(self, f, endian):
+        """Parse the array flags, dimensions and name of a miMATRIX element positioned after its tag."""
+        # array flags
+        _, nbytes, small = self._read_v5_element(f, endian)
+        flags = struct.unpack(endian + 'II', f.read(8))[0]
+        mx_class = flags & 0xFF
+        if mx_class not in _MX_DTYPES or flags & _MX_COMPLEX:
+            return None
+        # dimensions
+        _, nbytes, small = self._read_v5_element(f, endian)
+        shape = struct.unpack(endian + 'i' * (nbytes // 4), f.read(nbytes))
+        f.read((4 - nbytes) % 4 if small else -nbytes % 8)
+        # array name
+        _, nbytes, small = self._read_v5_element(f, endian)
+        name = f.read(nbytes).decode('ascii')
+        f.read((4 - nbytes) % 4 if small else -nbytes % 8)
+        # real part, MATLAB may store it in a smaller type than its class
+        mi_type, nbytes, small = self._read_v5_element(f, endian)
+        if mi_type not in _MI_DTYPES:
+            return None
+        stored = np.dtype(endian + _MI_DTYPES[mi_type])
+        if nbytes != stored.itemsize * int(np.prod(shape)):
+            return None
+        return name, f.tell(), tuple(shape), stored, np.dtype(_MX_DTYPES[mx_class])
+
+    def read(self, name, index=None):
+        """
+        Read a variable (or only a slice of it) from the .mat file.
+        :param name: Name of the variable in the .mat file.
+        :type name: str
+        :param index: (optional) numpy index applied to the variable with MATLAB's shape, e.g. (slice(None), 3) for
+                      the 4th column. Only the requested part is read from disk when the variable is memory mapped
+                      (uncompressed v5) or stored in HDF5 (v7.3). Compressed v5 variables are decompressed on the
+                      first read and kept in memory for the next ones.
+        :return: numpy array with the requested data
+        """
+        if name not in self.variables:
+            raise KeyError(f"Variable '{name}' not found in {self.mat_file}")
+        if index is None:
+            index = ()
+        if self.is_hdf5:
+            return self._read_hdf5(name, index)
+        if name in self._v5_offsets:
+            offset, shape, stored, dtype = self._v5_offsets[name]
+            arr = np.memmap(self.mat_file, dtype=stored, mode='r', offset=offset, shape=shape, order='F')
+            return np.array(arr[index], dtype=dtype)
+        # compressed variables can't be sliced on disk, decompress them once and slice the cached array
+        if name not in self._cache:
+            # mat_dtype returns the MATLAB class (as the memory mapped path does), not the smaller storage type
+            self._cache[name] = sio.loadmat(self.mat_file, variable_names=[name], mat_dtype=True)[name]
+        return np.array(self._cache[name][index])
+
+    def _read_hdf5(self, name, index):
+        """Read a v7.3 variable, translating the MATLAB (column-major) index to the HDF5 layout."""
+        with h5py.File(self.mat_file, 'r') as f:
+            dset = f[name]
+            if not isinstance(index, tuple):
+                index = (index,)
+            index = index + (slice(None),) * (dset.ndim - len(index))
+            offset = dset.id.get_offset()
+            if offset is not None and dset.chunks is None and dset.compression is None:
+                # contiguous dataset, memory map it
+                arr = np.memmap(self.mat_file, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+                return np.array(arr.T[index])
+            return np.asarray(dset[index[::-1]]).T
+
+    def ctd_kwargs(self, z='z_CTD', T='T_CTD', z_index=None, T_index=None):
+        """
+        Get the CTD profile keyword arguments of initCond4si3d.
+        :param z: Name of the depth variable in the .mat file (positive depths).
+        :param T: Name of the temperature variable in the .mat file.
+        :param z_index: (optional) index applied to the depth variable.
+        :param T_index: (optional) index applied to the temperature variable, e.g. (itime, slice(None)) to pick a
+                        single profile out of a time x depth record.
+        :return: dict with keys z_CTD and T_CTD as 1-D arrays
+        """
+        z_CTD = np.ravel(self.read(z, z_index))
+        T_CTD = np.ravel(self.read(T, T_index))
+        if len(z_CTD) != len(T_CTD):
+            raise ValueError(f"ERROR: {z} has {len(z_CTD)} values but {T} has {len(T_CTD)} values.")
+        return {'z_CTD': z_CTD, 'T_CTD': T_CTD}
+
+    def tracer_kwargs(self, z='z_Tr', conc='conc_Tr', z_index=None, conc_index=None):
+        """
+        Get the tracer keyword arguments of initCond4si3d.
+        :param z: Name of the tracer depth variable in the .mat file (depth x NTracers).
+        :param conc: Name of the tracer concentration variable in the .mat file (depth x NTracers).
+        :param z_index: (optional) index applied to the depth variable.
+        :param conc_index: (optional) index applied to the concentration variable.
+        :return: dict with keys z_Tr and conc_Tr as 2-D arrays
+        """
+        z_Tr = np.atleast_2d(self.read(z, z_index))
+        conc_Tr = np.atleast_2d(self.read(conc, conc_index))
+        # single tracer stored as a row vector
+        if z_Tr.shape[0] == 1:
+            z_Tr = z_Tr.T
+        if conc_Tr.shape[0] == 1:
+            conc_Tr = conc_Tr.T
+        return {'z_Tr': z_Tr, 'conc_Tr': conc_Tr}
+
+    def met_kwargs(self, names, index=None):
+        """
+        Get meteorological series as 1-D arrays.
+        :param names: dict mapping surfbc4si3d argument names (eta, Hswn, Ta, Pa, RH, Cl, Hlwin, cw, u, v, TimeSim)
+                      to the name of the variable in the .mat file.
+        :param index: (optional) index applied to every series, e.g. slice(t0, t1) for a time window.
+        :return: dict with the same keys as names
+        """
+        return {key: np.ravel(self.read(var, index)) for key, var in names.items()}
+
+    def surfbc_args(self, surfbcType, names, index=None):
+        """
+        Get the positional *args of surfbc4si3d for the RunTime1 and RunTime2 surface boundary condition types.
+        :param surfbcType: 'RunTime1' or 'RunTime2'
+        :param names: dict as in met_kwargs
+        :param index: (optional) index applied to every series
+        :return: tuple of arrays in the order expected by surfbc4si3d
+        """
+        if surfbcType == 'RunTime1':
+            order = ['eta', 'Hswn', 'Ta', 'Pa', 'RH', 'Cl', 'cw', 'u', 'v', 'TimeSim']
+        elif surfbcType == 'RunTime2':
+            order = ['eta', 'Hswn', 'Ta', 'Pa', 'RH', 'Hlwin', 'cw', 'u', 'v', 'TimeSim']
+        else:
+            raise ValueError(f"ERROR: surfbcType must be 'RunTime1' or 'RunTime2', not {surfbcType}")
+        missing = [key for key in order if key not in names]
+        if missing:
+            raise KeyError(f"Missing .mat variable names for: {', '.join(missing)}")
+        met = self.met_kwargs({key: names[key] for key in order}, index)
+        return tuple(met[key] for key in order)
+
+
+if __name__ == "__main__":
+    mat = MatLoader('_matlibrary_/Example/Llanquihue_T.mat')
+    print(mat.variables)
@@ -10,6 +10,8 @@ Functions that are present within this script are:
     if the basin is spherical use the functions as: bathy4si3d(BasinType,SimName,dx,D,H)
     if the basin is cylindrical use the functions as: bathy4si3d(BasinType,SimName,dx,D,H)
     Where L,B,H are the dimensions of length, width, and depth for the rectangular basin. D,H are the diameter and depth respectively for the cylindrical and spherical basins.
+    For a real lake, isolated wet cells (puddles, single cell inlets) can be removed with bathy4si3d(BasinType,SimName,dx,PathSave,xg,yg,zg,clean=True), see cleanBathy4si3d.
+    Steep slopes can be limited with the maxSlope or rx0 keyword arguments (e.g. bathy4si3d(...,maxSlope=0.1)), see smoothBathy4si3d.
     The file name will have the description of the grid size dx and the type of basin. This is for referencing but the user must change this name to 'h' to be able to run simulations in Si3D model
 2. initCond4si3d
     This function writes the initial condition file 'si3d_init.txt' for si3d simulations. The code considers constant and variable thickness layers, and the same for the temperature profiles. The use of the function is shown next for each of the scenarios. (4)
@@ -34,6 +36,19 @@ Functions that are present within this script are:
     Ta stands for air temperature, Pa for atmospheric pressure, RH relative humidity, eta the light penetration coefficient (secchi depth dependent), CL is cloud cover, WaTemp is the surface water temperature.
     Pa_P is the ratio of the atmospheric pressute at site in comparison to sea pressure, Hswn is the net shortwave radiation, Hlwin and HLwout stand for the incoming and outgoing longwave radiation. Finally, cw stands for wind drag coefficient.
 
+5. surfbcAppend4si3d
+    This function appends new records to an existing 'surfbc.txt' (e.g. hourly updates of an operational forecast) without rewriting the previous records. The new records must continue the last time stamp of the file, the npts header is updated in place.
+    surfbcAppend4si3d(surfbcType,days,dt,PathSave,eta,Hswn,Ta,Pa,RH,Cl,cw,u,v) (use Hlwin in place of Cl for RunTime2, and eta,Hswn,Hn,cw,u,v for Preprocess)
+6. partition4si3d
+    This function counts the active cells of each water column from the bathymetry array (bathy4si3d or BathyFileMaker) and the layers (si3d_layer.txt or constant dz) and proposes row or column blocks with the same amount of work for parallel psi3d runs, reporting the expected imbalance. jobScript4si3d(JobName,PathSave,nparts,partition) writes the recommendation into the 'run.sh' job script.
+
+7. ensemblePerturb4si3d and ensembleSurfbc4si3d
+    These functions create an ensemble of forcings for probabilistic forecasts by perturbing a base met record (additive, multiplicative or AR(1) time-correlated, seeded), and write one surfbc file per member in parallel. Hn is computed for all the members at once with HeatBudget for the Preprocess type.
+    members = ensemblePerturb4si3d({'u':u,'v':v,...},nMembers,{'u':{'type':'additive','sigma':0.5,'phi':0.9},...},seed)
+    ensembleSurfbc4si3d(LakeName,surfbcType,days,hr,mins,year,dt,PathSave,members)
+
+All the writers take PathSave as the folder where the file is saved with its default name (as before), a file path, or any writable text/binary file-like object or bytearray, so input decks can be generated in memory (see openOutput). The working directory is not changed.
+
 For a better understanding on the use of these functions, the reader is directed to the corresponding repositories that make use of the functions in here. "surfBondCond.py", InitConditions.py", and ""bathymetry.py"
 
 Copy right Sergio A. Valbuena 2021
@@ -42,12 +57,98 @@ February 2021
 """
 import sys
 import os
+import re
+import io
+import warnings
 import numpy as np
+from scipy import ndimage, signal
 import matplotlib.pyplot as plt
 import datetime as Dt
+from concurrent.futures import ThreadPoolExecutor
+
+# si3d reads npts with (10X,G11.2), keep it in a fixed-width field so it can be updated in place
+NPTS_LABEL = '   npts = '
+NPTS_WIDTH = 11
+# Row formats of surfbc.txt
+SURFBC_PREPROCESS_FMT = '%10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+SURFBC_RUNTIME_FMT = '%10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+SURFBC_RUNTIME_HIGHPA_FMT = '%10.4f %10.4f %10.4f %10.4f %10.3f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+
+
+class _OutputWriter(object):
+    """Writes the str output of a writer to a text or binary file-like object or bytearray without closing it."""
+    def __init__(self, write):
+        self._write = write
+
+    def write(self, s):
+        self._write(s)
+
+    def writelines(self, lines):
+        for s in lines:
+            self._write(s)
+
+    def close(self):
+        pass
 
+    def __enter__(self):
+        return self
 
-def bathy4si3d(BasinType, SimName, dx, PathSave, *args):
+    def __exit__(self, *exc):
+        self.close()
+
+
+def outputPath(PathSave, filename):
+    """
+    Resolves the file written by a writer when PathSave is a path.
+    :param PathSave: existing folder (the file is filename in it) or file path. A path ending with a separator is a
+                     folder and must exist, a file path must be in an existing folder.
+    :param filename: default name of the file when PathSave is a folder
+    :return: path of the file
+    """
+    path = os.fspath(PathSave)
+    if os.path.isdir(path):
+        return os.path.join(path, filename)
+    if path.endswith(os.sep) or (os.altsep is not None and path.endswith(os.altsep)):
+        raise FileNotFoundError('ERROR: the output folder does not exist: ' + path)
+    if not os.path.isdir(os.path.dirname(path) or os.curdir):
+        raise FileNotFoundError('ERROR: the folder of the output file does not exist: ' + path)
+    return path
+
+
+def openOutput(PathSave, filename, newline=None):
+    """
+    Opens the output of a writer. Nothing global (like the working directory) is changed, so writers can run
+    concurrently and stream their output to any target.
+    :param PathSave: existing folder (the file is created in it with the default filename), file path in an existing
+                     folder (see outputPath), writable text or binary file-like object (e.g. io.StringIO, io.BytesIO,
+                     a socket/HTTP response stream) or bytearray
+    :param filename: default name of the file when PathSave is a folder
+    :param newline: newline mode used when a file is opened
+    :return: object with write, writelines and close methods. File-like objects given by the caller are not closed.
+    """
+    if isinstance(PathSave, (str, os.PathLike)):
+        return open(outputPath(PathSave, filename), 'w', newline=newline)
+    if isinstance(PathSave, bytearray):
+        return _OutputWriter(lambda s: PathSave.extend(s.encode()))
+    if isinstance(PathSave, io.TextIOBase):
+        return _OutputWriter(PathSave.write)
+    try:
+        PathSave.write('')
+    except TypeError:
+        # binary stream
+        return _OutputWriter(lambda s: PathSave.write(s.encode()))
+    return _OutputWriter(PathSave.write)
+
+
+def outputName(PathSave, filename):
+    """Name of the output of a writer used in messages."""
+    if isinstance(PathSave, (str, os.PathLike)):
+        return outputPath(PathSave, filename)
+    return type(PathSave).__name__ + ' buffer'
+
+
+def bathy4si3d(BasinType, SimName, dx, PathSave, *args, clean=False, keep=1, channelRule=None, maxSlope=None,
+               rx0=None):
     """
     Creates a bathymetry file for SI3D.
     :param BasinType: Integer corresponding to basin type 1: Lake, type 2: rectangular, or type 3: circular.
@@ -55,8 +156,14 @@ def bathy4si3d(BasinType, SimName, dx, PathSave, *args):
     :param SimName:
     :type SimName: str
     :param dx:
-    :param PathSave:
+    :param PathSave: folder where the file is saved with its default name, file path, or writable file-like object or
+                     bytearray (see openOutput)
     :param args:
+    :param clean: if True, isolated wet cells of a Lake basin are removed with cleanBathy4si3d
+    :param keep: regions kept by the cleanup, see cleanBathy4si3d
+    :param channelRule: rule for one cell wide features, see cleanBathy4si3d
+    :param maxSlope: (optional) maximum bottom slope, the bathymetry is smoothed with smoothBathy4si3d
+    :param rx0: (optional) maximum slope parameter |h1-h2|/(h1+h2), see smoothBathy4si3d
     :return: (x, y, z) tuple of numpy 2D meshgrids corresponding to x, y, z coordinates of bathymetry data
     """
     dxsave = ' (dx= ' + str(dx) + '),'
@@ -81,6 +188,8 @@ def bathy4si3d(BasinType, SimName, dx, PathSave, *args):
         idata = ~np.isnan(zg)
         zz[idata] = zg[idata] * (-10)
         Z = zz
+        if clean:
+            Z, _ = cleanBathy4si3d(Z, keep, channelRule)
     elif BasinType == 2:
         basin = 'rectangular'
         L = args[0]
@@ -116,10 +225,13 @@ def bathy4si3d(BasinType, SimName, dx, PathSave, *args):
     else:
         H = 1
 
-    os.chdir(PathSave)
+    if maxSlope is not None or rx0 is not None:
+        Z, report = smoothBathy4si3d(Z, dx, maxSlope, rx0)
+        if not report['converged']:
+            raise ValueError('ERROR: the bathymetry smoothing did not meet maxSlope/rx0, relax the limits')
     ny, nx = np.shape(Z)
     filename = 'h' + str(int(dx)) + 'm_' + basin
-    fid = open(filename, "w+")
+    fid = openOutput(PathSave, filename)
     fid.write("%s" % Entry + '   imx =  ' + str(nx) + ',jmx =  ' + str(ny) + ',ncols = ' + str(nx))
     fid.write("\n")
     H1 = 'HV       V'
@@ -138,19 +250,191 @@ def bathy4si3d(BasinType, SimName, dx, PathSave, *args):
         fid.write('\n')
 
     fid.close()
-    print('The bathymetry file was save in ' + PathSave + ' as ' + filename)
+    print('The bathymetry file was saved as ' + outputName(PathSave, filename))
     return X, Y, Z
 
 
-def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers, **kw):
+def cleanBathy4si3d(Z, keep=1, channelRule=None):
+    """
+    Removes isolated wet cells from a bathymetry array. Wet cells are only connected through their faces (N, S, E, W)
+    as in the si3d grid, so puddles and checkerboard cells touching the basin by a corner are disconnected.
+    :param Z: bathymetry array as returned by bathy4si3d or BathyFileMaker.dem_array, depths in dm and -99 for land
+    :param keep: number of regions to keep starting from the largest one (default 1, the main basin), or a list of
+                 (row, col) cells, the regions containing them are kept. The cells must be wet.
+    :param channelRule: (optional) rule to remove one cell wide features before labeling the regions.
+                        'deadend' repeatedly removes cells with at most one wet neighbour (single cell inlets),
+                        'width1' also removes cells without wet neighbours on either side in N-S or E-W, i.e. every
+                        one cell wide channel.
+    :return: (cleaned bathymetry array, dict with the number of removed cells)
+    """
+    wet0 = Z > 0
+    wet = wet0.copy()
+    if channelRule is not None and channelRule not in ('deadend', 'width1'):
+        raise ValueError("ERROR: channelRule must be None, 'deadend' or 'width1', not " + str(channelRule))
+    while channelRule is not None:
+        p = np.pad(wet, 1)
+        n, s, w, e = p[:-2, 1:-1], p[2:, 1:-1], p[1:-1, :-2], p[1:-1, 2:]
+        if channelRule == 'deadend':
+            remove = wet & (n.astype(int) + s + w + e <= 1)
+        else:
+            remove = wet & ((~n & ~s) | (~w & ~e))
+        if not remove.any():
+            break
+        wet &= ~remove
+    removedChannels = int(wet0.sum() - wet.sum())
+
+    labels, nregions = ndimage.label(wet)
+    if isinstance(keep, (int, np.integer)):
+        sizes = np.bincount(labels.ravel(), minlength=nregions + 1)[1:]
+        keepLabels = np.argsort(sizes)[::-1][:keep] + 1
+    else:
+        rows, cols = np.asarray(keep).reshape(-1, 2).T
+        keepLabels = labels[rows, cols]
+        if np.any(keepLabels == 0):
+            dry = [(int(i), int(j)) for i, j, lab in zip(rows, cols, keepLabels) if lab == 0]
+            raise ValueError('ERROR: the keep cells ' + str(dry) + ' are not wet' +
+                             (' after removing one cell wide features' if channelRule is not None else ''))
+    wet &= np.isin(labels, keepLabels)
+    Zclean = np.where(wet0 & ~wet, -99, Z)
+    report = {'regions': nregions, 'removedChannels': removedChannels,
+              'removedRegions': int(wet0.sum() - wet.sum()) - removedChannels, 'removed': int(wet0.sum() - wet.sum()),
+              'wet': int(wet.sum())}
+    print('Bathymetry cleanup: ' + str(report['removed']) + ' wet cells removed (' + str(removedChannels) +
+          ' in one cell wide features, ' + str(report['removedRegions']) + ' in ' +
+          str(nregions - len(np.unique(keepLabels))) + ' isolated regions), ' + str(report['wet']) + ' wet cells left')
+    return Zclean, report
+
+
+def _slopeStats(H, wet, dx):
+    """Slope |dh|/dx and rx0 = |h1-h2|/(h1+h2) of the faces between wet cells, H in m."""
+    slope, rx0 = [], []
+    faces = ((H[:, :-1], H[:, 1:], wet[:, :-1] & wet[:, 1:]), (H[:-1, :], H[1:, :], wet[:-1, :] & wet[1:, :]))
+    for h1, h2, face in faces:
+        d, hs = h2 - h1, h1 + h2
+        slope.append(np.abs(d[face]) / dx)
+        rx0.append(np.abs(d[face]) / hs[face])
+    slope, rx0 = np.concatenate(slope), np.concatenate(rx0)
+    if len(slope) == 0:
+        return {'maxSlope': 0.0, 'meanSlope': 0.0, 'p95Slope': 0.0, 'maxRx0': 0.0}
+    return {'maxSlope': slope.max(), 'meanSlope': slope.mean(), 'p95Slope': np.percentile(slope, 95),
+            'maxRx0': rx0.max()}
+
+
+def _rowEnvelope(h, wet, L):
+    """
+    Lower envelope min_j(h_j + L*|k - j|) along each row, over the runs of wet cells (land cells break the runs).
+    Computed with one forward and one backward cumulative minimum.
+    """
+    n = h.shape[1]
+    k = np.arange(n)
+    big = 2 * (np.max(np.abs(h[wet]), initial=0) + L * n) + 1
+
+    def forward(h, wet):
+        # each run of wet cells gets a lower offset than the previous ones so the cumulative minimum restarts at land
+        offset = np.cumsum(~wet, axis=1) * big
+        v = np.where(wet, h - L * k, np.inf) - offset
+        return np.minimum.accumulate(v, axis=1) + offset + L * k
+
+    env = np.minimum(forward(h, wet), forward(h[:, ::-1], wet[:, ::-1])[:, ::-1])
+    return np.where(wet, env, h)
+
+
+def _lowerEnvelope(h, wet, L, maxIter):
+    """
+    Largest field below h whose difference across every face between wet cells is at most L. Row and column sweeps
+    are alternated until the field stops changing (to round-off).
+    :return: (envelope, True if the sweeps converged)
+    """
+    for _ in range(maxIter):
+        new = _rowEnvelope(h, wet, L)
+        new = _rowEnvelope(new.T, wet.T, L).T
+        if np.max(np.abs(new - h), initial=0) <= 1e-9 * L:
+            return new, True
+        h = new
+    return h, False
+
+
+def _limitFaces(h, wet, L, maxIter):
+    """
+    Limits the difference across the faces between wet cells to L with the mean of the lower envelope (deep cells
+    raised) and the upper envelope (shallow cells deepened). Both envelopes meet the limit, so their mean does too.
+    """
+    lower, done1 = _lowerEnvelope(h, wet, L, maxIter)
+    upper, done2 = _lowerEnvelope(-h, wet, L, maxIter)
+    return np.where(wet, (lower - upper) / 2, h), done1 and done2
+
+
+def smoothBathy4si3d(Z, dx, maxSlope=None, rx0=None, maxIter=100):
+    """
+    Limits the bottom slope of a bathymetry array. Depths across the faces between wet cells are limited with
+    sequential row/column sweeps that raise the deep side and deepen the shallow side of steep faces. The wet/dry
+    mask does not change and the basin volume is restored afterwards, by adding the same depth to every wet cell
+    (maxSlope, slopes unchanged) or by scaling the depths (rx0, slope parameter unchanged).
+    :param Z: bathymetry array as returned by bathy4si3d or BathyFileMaker.dem_array, depths in dm and -99 for land
+    :param dx: horizontal grid size in m
+    :param maxSlope: (optional) maximum slope |dh|/dx between neighbouring cells (m/m)
+    :param rx0: (optional) maximum slope parameter |h1-h2|/(h1+h2) between neighbouring cells, must be < 1
+    :param maxIter: maximum number of sweeps, and of alternations between the two limits when both are given
+    :return: (smoothed bathymetry array, dict with the slope statistics before and after, volumes, iterations and
+             whether both limits were met). A warning is issued when they are not met.
+    """
+    if maxSlope is None and rx0 is None:
+        raise ValueError('ERROR: either maxSlope or rx0 must be given to smooth the bathymetry')
+    if maxSlope is not None and not maxSlope > 0:
+        raise ValueError('ERROR: maxSlope must be positive, not ' + str(maxSlope))
+    if rx0 is not None and not 0 < rx0 < 1:
+        raise ValueError('ERROR: rx0 must be between 0 and 1, not ' + str(rx0))
+    wet = Z > 0
+    H = np.where(wet, np.asarray(Z, dtype=float) / 10, 0)
+    before = _slopeStats(H, wet, dx)
+    volume = H.sum() * dx ** 2
+    nwet = np.count_nonzero(wet)
+    Hmin = H[wet].min() if nwet else 0
+    # relative tolerance of the limits, well below the dm precision of the bathy file
+    tol = 1e-3
+    for it in range(maxIter):
+        done = True
+        if maxSlope is not None:
+            H, done = _limitFaces(H, wet, maxSlope * dx, maxIter)
+            H = np.where(wet, np.maximum(H + (volume / dx ** 2 - H.sum()) / max(nwet, 1), Hmin), 0)
+        if rx0 is not None:
+            # rx0 <= r is |log h1 - log h2| <= log((1 + r)/(1 - r))
+            G, doneRx0 = _limitFaces(np.log(np.where(wet, H, 1)), wet, np.log((1 + rx0) / (1 - rx0)), maxIter)
+            H = np.where(wet, np.exp(G), 0)
+            H *= volume / dx ** 2 / H.sum() if nwet else 1
+            done = done and doneRx0
+        after = _slopeStats(H, wet, dx)
+        done = (done and (maxSlope is None or after['maxSlope'] <= maxSlope * (1 + tol)) and
+                (rx0 is None or after['maxRx0'] <= rx0 * (1 + tol)))
+        if done or maxSlope is None or rx0 is None:
+            break
+    Zsmooth = np.where(wet, H * 10, Z)
+    report = {'before': before, 'after': after, 'volume': volume, 'volumeSmooth': H.sum() * dx ** 2,
+              'iterations': it + 1, 'converged': done}
+    print('Bathymetry smoothing (' + str(report['iterations']) + ' iterations' + ('' if done else ', NOT converged') +
+          '):')
+    for key in ('maxSlope', 'meanSlope', 'p95Slope', 'maxRx0'):
+        print('   %-9s before %8.4f   after %8.4f' % (key, before[key], after[key]))
+    print('   volume change: %.2e %%' % (100 * (report['volumeSmooth'] - volume) / volume if volume > 0 else 0))
+    if not done:
+        warnings.warn('Bathymetry smoothing did not meet the slope limits after ' + str(report['iterations']) +
+                      ' iterations')
+    return Zsmooth, report
+
+
+def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers, PathLayer=None, **kw):
     """
     Creates an initial condition file for SI3D
     :param LakeName:
     :param SimStartDate:
     :param DeltaZ:
     :param TempProf:
-    :param PathSave:
+    :param PathSave: folder where si3d_init.txt is saved, file path, or writable file-like object or bytearray
+                     (see openOutput)
     :param NTracers:
+    :param PathLayer: output of the layer file for variable thickness layers (see LayerGenerator). By default it is
+                      saved as si3d_layer.txt in the folder of PathSave, it must be given if PathSave is a file-like
+                      object.
     :param kw:
     :return:
     """
@@ -169,6 +453,11 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
         if NTracers != 0:
             dummy1 = 'Depths (m) not used   Temp (oC)   Tracers (g/L) --> - '
     elif DeltaZ == 'variable':
+        if PathLayer is None:
+            if not isinstance(PathSave, (str, os.PathLike)):
+                raise ValueError('ERROR: PathLayer must be given for variable thickness layers when PathSave is not a '
+                                 'path')
+            PathLayer = os.path.dirname(outputPath(PathSave, 'si3d_init.txt')) or os.curdir
         # Length of initial grid for creating the unevenly spaced grid
         N = 1000
         gridks = np.arange(1, N + 1, 1)
@@ -181,7 +470,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
                 kml = km + 2
                 surf = np.array([-100, -100])
                 zlevel = np.concatenate((surf, gridZ[0:km + 1]))
-                Layer = LayerGenerator(zlevel, kml, PathSave)
+                Layer = LayerGenerator(zlevel, kml, PathLayer)
                 zz = np.zeros(len(zlevel) - 1)
                 zz[1:] = zlevel[2:]
                 zi = -(zz[0:-1] + zz[1:]) / 2
@@ -204,7 +493,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
                 kml = km + 2
                 surf = np.array([-100, -100])
                 zlevel = np.concatenate((surf, gridZ))
-                Layer = LayerGenerator(zlevel, kml, PathSave)
+                Layer = LayerGenerator(zlevel, kml, PathLayer)
                 zz = zlevel[1:]
                 zz[0] = 0
                 zi = -(zz[0:-1] + zz[1:]) / 2
@@ -228,7 +517,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
                 kml = km + 2
                 surf = np.array([-100, -100])
                 zlevel = np.concatenate((surf, gridZ))
-                Layer = LayerGenerator(zlevel, kml, PathSave)
+                Layer = LayerGenerator(zlevel, kml, PathLayer)
                 zz = zlevel[1:]
                 zz[0] = 0
                 zi = -(zz[0:-1] + zz[1:]) / 2
@@ -244,7 +533,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
                 kml = km + 2
                 surf = np.array([-100, -100])
                 zlevel = np.concatenate((surf, gridZ[0:km + 1]))
-                Layer = LayerGenerator(zlevel, kml, PathSave)
+                Layer = LayerGenerator(zlevel, kml, PathLayer)
                 zz = np.zeros(len(zlevel) - 1)
                 zz[1:] = zlevel[2:]
                 zi = -(zz[0:-1] + zz[1:]) / 2
@@ -267,7 +556,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
                 kml = km + 2
                 surf = np.array([-100, -100])
                 zlevel = np.concatenate((surf, gridZ))
-                Layer = LayerGenerator(zlevel, kml, PathSave)
+                Layer = LayerGenerator(zlevel, kml, PathLayer)
                 zz = zlevel[1:]
                 zz[0] = 0
                 zi = -(zz[0:-1] + zz[1:]) / 2
@@ -295,7 +584,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
                 kml = km + 2
                 surf = np.array([-100, -100])
                 zlevel = np.concatenate((surf, gridZ))
-                Layer = LayerGenerator(zlevel, kml, PathSave)
+                Layer = LayerGenerator(zlevel, kml, PathLayer)
                 zz = zlevel[1:]
                 zz[0] = 0
                 zi = -(zz[0:-1] + zz[1:]) / 2
@@ -310,8 +599,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
         dummy1 = 'Depths (m)   Temp (oC)   Tracers (g/L) -->       - '
 
     # ----------------------- Creation of file ---------------------------------
-    os.chdir(PathSave)
-    fid = open('si3d_init.txt', 'w+')
+    fid = openOutput(PathSave, 'si3d_init.txt')
     fid.write('%s\n' % 'Initial condition file for si3d model            - ')
     fid.write('%s' % LakeName + '             - ' + '\n')
     fid.write('%s' % 'Simulation starting on ' + SimStartDate + ' UTC    - ' + '\n')
@@ -320,10 +608,7 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
     fid.write('%s\n' % '-------------------------------------------------- ')
 
     if NTracers == 0:
-        fid.write('%10.2f %10.4f \n' % (z[0], T[0]))
-        for i in range(0, len(T)):
-            fid.write('%10.2f %10.4f \n' % (z[i], T[i]))
-        fid.write('%10.2f %10.4f \n' % (z[i], T[i]))
+        fid.write(initRows(z, T))
     else:
         _, cols1 = kw['z_Tr'].shape
         _, cols2 = kw['conc_Tr'].shape
@@ -335,33 +620,41 @@ def initCond4si3d(LakeName, SimStartDate, DeltaZ, TempProf, PathSave, NTracers,
         tracers = np.empty((len(z), NTracers)) * np.nan
         for i in range(0, NTracers):
             tracers[:, i] = np.interp(-z, kw['z_Tr'][:, i], kw['conc_Tr'][:, i])
-        fid.write('%10.2f %10.4f' % (z[0], T[0]))
-        for j in range(0, NTracers):
-            fid.write('%11.4f' % tracers[0, j])
-        fid.write('\n')
-        for i in range(0, len(T)):
-            fid.write('%10.2f %10.4f' % (z[i], T[i]))
-            for j in range(0, NTracers):
-                fid.write('%11.4f' % tracers[i, j])
-            fid.write('\n')
-        fid.write('%10.2f %10.4f' % (z[i], T[i]))
-        for j in range(0, NTracers):
-            fid.write('%11.4f' % tracers[i, j])
-        fid.write('\n')
+        fid.write(initRows(z, T, tracers))
 
     fid.close()
     return T, z
 
+
+def initRows(z, T, tracers=None):
+    """
+    Body of the initial condition file, the first and last layers are repeated as si3d expects. All the rows are
+    formatted in a single call so many profiles can be written fast (e.g. for sweeps of initial conditions).
+    :param z: depths of the layers (m, negative)
+    :param T: temperature of the layers
+    :param tracers: (optional) layers x NTracers array with the tracer concentrations
+    :return: str
+    """
+    if tracers is None:
+        rows = np.column_stack((z, T))
+        format = '%10.2f %10.4f \n'
+    else:
+        rows = np.column_stack((z, T, tracers))
+        format = '%10.2f %10.4f' + '%11.4f' * np.shape(tracers)[1] + '\n'
+    rows = np.concatenate((rows[:1], rows, rows[-1:]))
+    return (format * len(rows)) % tuple(rows.ravel().tolist())
+
+
 def LayerGenerator(zlevel, kml, PathSave):
     """
     This function is only used when the layer thickness is variable
     :param zlevel:
     :param kml:
-    :param PathSave:
+    :param PathSave: folder where si3d_layer.txt is saved, file path, or writable file-like object or bytearray
+                     (see openOutput)
     :return:
     """
-    os.chdir(PathSave)
-    fid = open('si3d_layer.txt', 'wt+')
+    fid = openOutput(PathSave, 'si3d_layer.txt')
     fid.write('%s\n' % 'Depths to top of layers in Si3D Grid            ')
     fid.write('%s\n' % '** used if ibathyf in si3d_inp.txt is set to < 0       ')
     fid.write('%s\n' % '------------------------------------------------------ ')
@@ -370,36 +663,46 @@ def LayerGenerator(zlevel, kml, PathSave):
         fid.write('%10.2f %10.4f \n' % (i + 1, zlevel[i]))
 
     fid.close()
-    Layer = 'Layer file created in the folder' + PathSave + ' with name si3d_layer.txt'
+    Layer = 'Layer file created as ' + outputName(PathSave, 'si3d_layer.txt')
     print(Layer)
     return Layer
 
 
+def nptsLine(r):
+    """
+    Header line with the number of records of a surfbc file. The value is right-justified in a fixed-width field so
+    surfbcAppend4si3d can update it in place.
+    :param r: number of records
+    :return: str
+    """
+    return NPTS_LABEL + str(r).rjust(NPTS_WIDTH) + '\n'
+
+
 def surfbcW4si3d(caseStudy, Time, dt, PathSave, cw, u, v):
     """
 
     :param caseStudy:
     :param Time:
     :param dt:
-    :param PathSave:
+    :param PathSave: folder where surfbcW.txt is saved, file path, or writable file-like object or bytearray
+                     (see openOutput)
     :param cw:
     :param u:
     :param v:
     :return:
     """
-    os.chdir(PathSave)
     r = len(Time)
     days = Time / 24
     daystart = Time[0]
 
-    fid = open('surfbcW.txt', 'wt+')
+    fid = openOutput(PathSave, 'surfbcW.txt')
     fid.write('%s\n' % 'Surface boundary condition file for si3d model')
     fid.write('%s' % caseStudy + ' simulations \n')
     fid.write('%s' % 'Time is given in hours from the start date used within the input.txt \n')
     fid.write('%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time cw ua va')
     fid.write('%s' % '   ' + str(dt) + '-min    // SOURCE = ' + caseStudy + ' Met Data \n')
     fid.write('%s' % ' intervals  (Note : file prepared on ' + str(Dt.date.today()) + '\n')
-    fid.write('%s' % '   npts = ' + str(r) + '\n')
+    fid.write(nptsLine(r))
     for i in range(0, r):
         a0 = (days[i] - daystart) * 24
         a1 = cw[i];  # **** Wind drag coefficient
@@ -407,9 +710,38 @@ def surfbcW4si3d(caseStudy, Time, dt, PathSave, cw, u, v):
         a3 = v[i];  # **** Wind speed in the NS direction
         format = '%10.4f %10.4f %10.4f %10.4f \n'
         fid.write(format % (a0, a1, a2, a3))
+    fid.close()
     return
 
 
+def surfbcHeader(LakeName, surfbcType, days, hr, mins, year, dt, r, HeatBudgetMethod=''):
+    """
+    Header of the surface boundary condition file written by surfbc4si3d and ensembleSurfbc4si3d.
+    :param r: number of records (npts)
+    :param HeatBudgetMethod: heat budget method, only written for the Preprocess surfbcType
+    :return: str with the 7 header lines
+    """
+    header = '%s\n' % 'Surface boundary condition file for si3d model'
+    header += '%s' % LakeName + ' simulations \n'
+    header += '%s' % 'Time is given in hours from ' + str(hr[0]) + ':' + str(mins[0]) + ' hrs on julian day ' + str(
+        days[0]) + ',' + str(year) + '\n'
+    if surfbcType == 'Preprocess':
+        header += '%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time attc Hsw Hn cw ua va'
+        header += '%s' % '   ' + str(dt) + '-min    // SOURCE = ' + LakeName + ' Met Data ' + str(year) + '\n'
+        header += '%s' % ' intervals  (Note : file prepared on ' + str(
+            Dt.date.today()) + 'HeatBudget = ' + HeatBudgetMethod + '\n'
+    elif surfbcType == 'RunTime1':
+        header += '%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time attc Hsw Ta Pa hr cc cw ua va'
+        header += '%s' % '   ' + str(dt) + '-min    // SOURCE = ' + LakeName + ' Met Data ' + str(year) + '\n'
+        header += '%s' % ' intervals  (Note : file prepared on ' + str(Dt.date.today()) + '\n'
+    elif surfbcType == 'RunTime2':
+        header += '%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time attc Hsw Ta Pa hr Hlw cw ua va'
+        header += '%s' % '   ' + str(dt) + '-min    // SOURCE = ' + LakeName + ' Met Data ' + str(year) + '\n'
+        header += '%s' % ' intervals  (Note : file prepared on ' + str(Dt.date.today()) + '\n'
+    header += nptsLine(r)
+    return header
+
+
 def surfbc4si3d(show, LakeName, surfbcType, days, hr, mins, year, dt, PathSave, *args):
     """
     Function to create surface boundary condition using a heat budget method.
@@ -423,26 +755,19 @@ def surfbc4si3d(show, LakeName, surfbcType, days, hr, mins, year, dt, PathSave,
     :param mins:
     :param year:
     :param dt:
-    :param PathSave:
+    :param PathSave: folder where surfbc.txt is saved, file path, or writable file-like object or bytearray
+                     (see openOutput)
     :param args:
     :return:
     """
-    os.chdir(PathSave)
     r = len(days)
     daystart = days[0]
     # To write the file surfbc for the numerical simulation in si3d
-    fid = open('surfbc.txt', 'wt+')
-    fid.write('%s\n' % 'Surface boundary condition file for si3d model')
-    fid.write('%s' % LakeName + ' simulations \n')
-    fid.write('%s' % 'Time is given in hours from ' + str(hr[0]) + ':' + str(mins[0]) + ' hrs on julian day ' + str(
-        days[0]) + ',' + str(year) + '\n')
+    fid = openOutput(PathSave, 'surfbc.txt')
+    fid.write(surfbcHeader(LakeName, surfbcType, days, hr, mins, year, dt, r,
+                           args[0] if surfbcType == 'Preprocess' else ''))
 
     if surfbcType == 'Preprocess':
-        fid.write('%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time attc Hsw Hn cw ua va')
-        fid.write('%s' % '   ' + str(dt) + '-min    // SOURCE = ' + LakeName + ' Met Data ' + str(year) + '\n')
-        fid.write('%s' % ' intervals  (Note : file prepared on ' + str(
-            Dt.date.today()) + 'HeatBudget = ' + HeatBudgetMethod + '\n')
-        fid.write('%s' % '   npts = ' + str(r) + '\n')
         HeatBudgetMethod = args[0]
         eta = args[1]
         Hswn = args[2]
@@ -497,13 +822,9 @@ def surfbc4si3d(show, LakeName, surfbcType, days, hr, mins, year, dt, PathSave,
             a4 = cw[j]
             a5 = u[i]
             a6 = v[i]
-            format = '%10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+            format = SURFBC_PREPROCESS_FMT
             fid.write(format % (a0, a1, a2, a3, a4, a5, a6))
     elif surfbcType == 'RunTime1':
-        fid.write('%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time attc Hsw Ta Pa hr cc cw ua va')
-        fid.write('%s' % '   ' + str(dt) + '-min    // SOURCE = ' + LakeName + ' Met Data ' + str(year) + '\n')
-        fid.write('%s' % ' intervals  (Note : file prepared on ' + str(Dt.date.today()) + '\n')
-        fid.write('%s' % '   npts = ' + str(r) + '\n')
         eta = args[0]
         Hswn = args[1]
         Ta = args[2]
@@ -526,43 +847,40 @@ def surfbc4si3d(show, LakeName, surfbcType, days, hr, mins, year, dt, PathSave,
             a8 = u[i];  # **** Wind speed in the EW direction
             a9 = v[i];  # **** Wind speed in the NS direction
             if a4 >= 100000:
-                format = '%10.4f %10.4f %10.4f %10.4f %10.3f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+                format = SURFBC_RUNTIME_HIGHPA_FMT
             else:
-                format = '%10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+                format = SURFBC_RUNTIME_FMT
             fid.write(format % (a0, a1, a2, a3, a4, a5, a6, a7, a8, a9))
-        fig1, (ax1, ax2, ax3, ax4) = plt.subplots(nrows=4, ncols=1)
-        fig2, (ax5, ax6, ax7, ax8) = plt.subplots(nrows=4, ncols=1)
-        fig1.set_size_inches(6, 8)
-        fig2.set_size_inches(6, 8)
-        ax1.plot(TimeSim, eta)
-        ax2.plot(TimeSim, Hswn)
-        ax3.plot(TimeSim, Cl)
-        ax4.plot(TimeSim, (u ** 2 + v ** 2) ** 0.5)
-        ax5.plot(TimeSim, Ta)
-        ax6.plot(TimeSim, Pa)
-        ax7.plot(TimeSim, RH)
-        ax8.plot(TimeSim, cw)
-
-        ax1.set_ylabel(r'$eta$')
-        plt.tight_layout()
-        ax2.set_ylabel(r'$Hswn\ [Wm^{-2}]$')
-        ax3.set_ylabel(r'$Cloud Cover$')
-        ax4.set_ylabel(r'$Wspd\ [ms^{-1}]$')
-        ax5.set_ylabel(r'$Ta\ [^{\circ}C]$')
-        ax6.set_ylabel(r'$Atm\ P\ [Pa]$')
-        ax7.set_ylabel(r'$RH$')
-        ax8.set_ylabel(r'$Wind\ Drag$')
-        ax8.set_xlabel('day of year')
-        plt.tight_layout()
+        # only build the figures when they are shown, pyplot keeps every open figure alive
         if show:
+            fig1, (ax1, ax2, ax3, ax4) = plt.subplots(nrows=4, ncols=1)
+            fig2, (ax5, ax6, ax7, ax8) = plt.subplots(nrows=4, ncols=1)
+            fig1.set_size_inches(6, 8)
+            fig2.set_size_inches(6, 8)
+            ax1.plot(TimeSim, eta)
+            ax2.plot(TimeSim, Hswn)
+            ax3.plot(TimeSim, Cl)
+            ax4.plot(TimeSim, (u ** 2 + v ** 2) ** 0.5)
+            ax5.plot(TimeSim, Ta)
+            ax6.plot(TimeSim, Pa)
+            ax7.plot(TimeSim, RH)
+            ax8.plot(TimeSim, cw)
+    
+            ax1.set_ylabel(r'$eta$')
+            plt.tight_layout()
+            ax2.set_ylabel(r'$Hswn\ [Wm^{-2}]$')
+            ax3.set_ylabel(r'$Cloud Cover$')
+            ax4.set_ylabel(r'$Wspd\ [ms^{-1}]$')
+            ax5.set_ylabel(r'$Ta\ [^{\circ}C]$')
+            ax6.set_ylabel(r'$Atm\ P\ [Pa]$')
+            ax7.set_ylabel(r'$RH$')
+            ax8.set_ylabel(r'$Wind\ Drag$')
+            ax8.set_xlabel('day of year')
+            plt.tight_layout()
             plt.show()
         else:
             print('No plot')
     elif surfbcType == 'RunTime2':
-        fid.write('%s\n' % '   Time in   // Data format is (10X,G11.2,...) Time attc Hsw Ta Pa hr Hlw cw ua va')
-        fid.write('%s' % '   ' + str(dt) + '-min    // SOURCE = ' + LakeName + ' Met Data ' + str(year) + '\n')
-        fid.write('%s' % ' intervals  (Note : file prepared on ' + str(Dt.date.today()) + '\n')
-        fid.write('%s' % '   npts = ' + str(r) + '\n')
         eta = args[0]
         Hswn = args[1]
         Ta = args[2]
@@ -585,36 +903,37 @@ def surfbc4si3d(show, LakeName, surfbcType, days, hr, mins, year, dt, PathSave,
             a8 = u[i]  # **** Wind speed in the EW direction
             a9 = v[i]  # **** Wind speed in the NS direction
             if a4 >= 100000:
-                format = '%10.4f %10.4f %10.4f %10.4f %10.3f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+                format = SURFBC_RUNTIME_HIGHPA_FMT
             else:
-                format = '%10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f \n'
+                format = SURFBC_RUNTIME_FMT
             fid.write(format % (a0, a1, a2, a3, a4, a5, a6, a7, a8, a9))
 
-        fig1, (ax1, ax2, ax3, ax4) = plt.subplots(nrows=4, ncols=1)
-        fig2, (ax5, ax6, ax7, ax8) = plt.subplots(nrows=4, ncols=1)
-        fig1.set_size_inches(6, 8)
-        fig2.set_size_inches(6, 8)
-        ax1.plot(TimeSim, eta)
-        ax2.plot(TimeSim, Hswn)
-        ax3.plot(TimeSim, Hlwin)
-        ax4.plot(TimeSim, (u ** 2 + v ** 2) ** 0.5)
-        ax5.plot(TimeSim, Ta)
-        ax6.plot(TimeSim, Pa)
-        ax7.plot(TimeSim, RH)
-        ax8.plot(TimeSim, cw)
-
-        ax1.set_ylabel(r'$eta$')
-        plt.tight_layout()
-        ax2.set_ylabel(r'$Hswn\ [Wm^{-2}]$')
-        ax3.set_ylabel(r'$Hlwin\ [Wm^{-2}]$')
-        ax4.set_ylabel(r'$Wspd\ [ms^{-1}]$')
-        ax5.set_ylabel(r'$Ta\ [^{\circ}C]$')
-        ax6.set_ylabel(r'$Atm\ P\ [Pa]$')
-        ax7.set_ylabel(r'$RH$')
-        ax8.set_ylabel(r'$Wind\ Drag$')
-        ax8.set_xlabel('day of year')
-        plt.tight_layout()
+        # only build the figures when they are shown, pyplot keeps every open figure alive
         if show:
+            fig1, (ax1, ax2, ax3, ax4) = plt.subplots(nrows=4, ncols=1)
+            fig2, (ax5, ax6, ax7, ax8) = plt.subplots(nrows=4, ncols=1)
+            fig1.set_size_inches(6, 8)
+            fig2.set_size_inches(6, 8)
+            ax1.plot(TimeSim, eta)
+            ax2.plot(TimeSim, Hswn)
+            ax3.plot(TimeSim, Hlwin)
+            ax4.plot(TimeSim, (u ** 2 + v ** 2) ** 0.5)
+            ax5.plot(TimeSim, Ta)
+            ax6.plot(TimeSim, Pa)
+            ax7.plot(TimeSim, RH)
+            ax8.plot(TimeSim, cw)
+    
+            ax1.set_ylabel(r'$eta$')
+            plt.tight_layout()
+            ax2.set_ylabel(r'$Hswn\ [Wm^{-2}]$')
+            ax3.set_ylabel(r'$Hlwin\ [Wm^{-2}]$')
+            ax4.set_ylabel(r'$Wspd\ [ms^{-1}]$')
+            ax5.set_ylabel(r'$Ta\ [^{\circ}C]$')
+            ax6.set_ylabel(r'$Atm\ P\ [Pa]$')
+            ax7.set_ylabel(r'$RH$')
+            ax8.set_ylabel(r'$Wind\ Drag$')
+            ax8.set_xlabel('day of year')
+            plt.tight_layout()
             plt.show()
         else:
             print('No plot')
@@ -622,6 +941,318 @@ def surfbc4si3d(show, LakeName, surfbcType, days, hr, mins, year, dt, PathSave,
     fid.close()
 
 
+def _surfbcRowsEnd(fid, start, npts):
+    """
+    Finds the end of the first npts rows of a surfbc file.
+    :param fid: file opened in binary mode
+    :param start: offset of the first row
+    :param npts: number of rows
+    :return: (offset after row npts, or the end of the file if it has fewer rows, total number of rows)
+    """
+    fid.seek(start)
+    rowsEnd, nrows, pos = None, 0, start
+    while True:
+        chunk = fid.read(1 << 20)
+        if not chunk:
+            break
+        n = chunk.count(b'\n')
+        if rowsEnd is None and nrows + n >= npts:
+            i = -1
+            for _ in range(npts - nrows):
+                i = chunk.index(b'\n', i + 1)
+            rowsEnd = pos + i + 1 if npts > 0 else start
+        nrows += n
+        pos += len(chunk)
+    if rowsEnd is None:
+        rowsEnd = start if npts == 0 else pos
+    return rowsEnd, nrows
+
+
+def surfbcAppend4si3d(surfbcType, days, dt, PathSave, *args, filename='surfbc.txt'):
+    """
+    Appends new records to an existing surface boundary condition file created with surfbc4si3d, e.g. for an
+    operational forecast where new met data arrive every hour. Records at or before the last time stamp in the file
+    are dropped, the first new record must follow the last one after dt minutes. Only the new rows are written and
+    the npts header is updated in place. The rows are flushed to disk before npts changes, so a concurrent reader
+    only ever sees npts complete records. Files written before npts had a fixed-width field are rewritten to a
+    temporary file and renamed over the original instead.
+    Records past npts (left by an append interrupted before npts was updated) are dropped and replaced by the new
+    records.
+    The use of the function for each surfbcType is:
+    1) surfbcAppend4si3d('Preprocess',days,dt,PathSave,eta,Hswn,Hn,cw,u,v)
+    2) surfbcAppend4si3d('RunTime1',days,dt,PathSave,eta,Hswn,Ta,Pa,RH,Cl,cw,u,v)
+    3) surfbcAppend4si3d('RunTime2',days,dt,PathSave,eta,Hswn,Ta,Pa,RH,Hlwin,cw,u,v)
+    where the variables are the same as in surfbc4si3d (RH in %).
+    :param surfbcType: 'Preprocess', 'RunTime1' or 'RunTime2', must match the existing file
+    :param days: julian days of the new records, same reference as the days used to create the file
+    :param dt: time step of the records in minutes
+    :param PathSave: folder of the surfbc file or path to it (see outputPath)
+    :param args: met series for the new records
+    :param filename: name of the surfbc file
+    :return: total number of records (npts) in the file
+    """
+    path = outputPath(PathSave, filename)
+    if surfbcType == 'Preprocess':
+        ncols = 7
+    elif surfbcType in ('RunTime1', 'RunTime2'):
+        ncols = 10
+    else:
+        raise ValueError('ERROR: surfbcType must be Preprocess, RunTime1 or RunTime2, not ' + str(surfbcType))
+    if len(args) != ncols - 1:
+        raise ValueError('ERROR: ' + surfbcType + ' needs ' + str(ncols - 1) + ' met series, ' + str(len(args)) +
+                         ' were given')
+
+    # ----------------------- Existing file ------------------------------------
+    with open(path, 'rb') as fid:
+        header = [fid.readline() for _ in range(7)]
+        nptsOffset = sum(len(line) for line in header[:6]) + len(NPTS_LABEL)
+        dataStart = fid.tell()
+        if not header[6].decode().startswith(NPTS_LABEL):
+            raise IOError('ERROR: ' + path + ' does not have the header written by surfbc4si3d')
+        npts = int(header[6].decode().rstrip('\r\n')[len(NPTS_LABEL):])
+        # only the first npts rows count, rows past them are left by an interrupted append and are dropped
+        rowsEnd, nrows = _surfbcRowsEnd(fid, dataStart, npts)
+        if nrows < npts:
+            raise IOError('ERROR: ' + path + ' has ' + str(nrows) + ' records but npts = ' + str(npts))
+        fid.seek(max(rowsEnd - 1024, dataStart))
+        tail = fid.read(rowsEnd - fid.tell()).split(b'\n')
+    if nrows > npts:
+        print(str(nrows - npts) + ' records past npts = ' + str(npts) + ' in ' + path + ' are dropped')
+    daystart = re.search(r'julian day\s*([-+.\deE]+),', header[2].decode())
+    dtFile = re.search(r'([-+.\deE]+)-min', header[4].decode())
+    if daystart is None:
+        raise IOError('ERROR: ' + path + ' does not have the header written by surfbc4si3d')
+    daystart = float(daystart.group(1))
+    if dtFile is not None and float(dtFile.group(1)) != float(dt):
+        raise ValueError('ERROR: dt = ' + str(dt) + ' min does not match the ' + dtFile.group(1) + ' min of ' + path)
+    nptsField = header[6].decode().rstrip('\r\n')[len(NPTS_LABEL):]
+    rows = [line for line in tail if line.strip()]
+    last = rows[-1].split() if npts > 0 else None
+    if last is not None and len(last) != ncols:
+        raise ValueError('ERROR: ' + path + ' has ' + str(len(last)) + ' columns, ' + surfbcType + ' has ' +
+                         str(ncols))
+
+    # ----------------------- New records --------------------------------------
+    Time = (np.asarray(days, dtype=float) - daystart) * 24
+    values = [np.asarray(a, dtype=float) for a in args]
+    if surfbcType != 'Preprocess':
+        values[4] = values[4] / 100
+    inew = np.ones(len(Time), dtype=bool)
+    if last is not None:
+        lastTime = float(last[0])
+        # rows are written with 4 decimals, anything not past the last time stamp is already in the file
+        inew = Time > lastTime + 1e-4
+        if np.any(inew) and abs(Time[inew][0] - lastTime - dt / 60) > 1e-3:
+            raise ValueError('ERROR: the new records start at ' + '%.4f' % Time[inew][0] + ' h but the file ends at ' +
+                             '%.4f' % lastTime + ' h, records are expected every ' + str(dt) + ' min')
+    if np.any(np.diff(Time[inew]) <= 0):
+        raise ValueError('ERROR: the times of the new records must be increasing')
+    r = int(np.count_nonzero(inew))
+    if r == 0:
+        print('No new records to append to ' + path)
+        return npts
+    lines = []
+    for row in zip(Time[inew], *[a[inew] for a in values]):
+        if surfbcType == 'Preprocess':
+            format = SURFBC_PREPROCESS_FMT
+        elif row[4] >= 100000:
+            format = SURFBC_RUNTIME_HIGHPA_FMT
+        else:
+            format = SURFBC_RUNTIME_FMT
+        lines.append(format % row)
+    newRows = ''.join(lines).encode()
+    npts += r
+
+    # ----------------------- Append ---------------------------------------------
+    if len(nptsField) >= NPTS_WIDTH:
+        with open(path, 'r+b') as fid:
+            fid.seek(rowsEnd)
+            fid.write(newRows)
+            fid.truncate()
+            fid.flush()
+            os.fsync(fid.fileno())
+            fid.seek(nptsOffset)
+            fid.write(str(npts).rjust(len(nptsField)).encode())
+            fid.flush()
+            os.fsync(fid.fileno())
+    else:
+        # npts field too narrow to be updated in place, rewrite the file and replace it atomically
+        header[6] = nptsLine(npts).encode()
+        tmp = path + '.tmp'
+        with open(path, 'rb') as fid, open(tmp, 'wb') as out:
+            fid.seek(dataStart)
+            out.writelines(header)
+            while fid.tell() < rowsEnd:
+                out.write(fid.read(min(1 << 20, rowsEnd - fid.tell())))
+            out.write(newRows)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, path)
+    print(str(r) + ' records appended to ' + path + ', npts = ' + str(npts))
+    return npts
+
+
+def activeCells4si3d(Z, zlevel=None, dz=None):
+    """
+    Counts the active (wet) cells of every water column of the grid.
+    :param Z: bathymetry array as returned by bathy4si3d or BathyFileMaker.dem_array, depths in dm and -99 for land
+    :param zlevel: depths to the top of the layers as given to LayerGenerator (the two leading -100 are ignored), or
+                   the path to a si3d_layer.txt file. Used for variable thickness layers.
+    :param dz: layer thickness in m, used for constant thickness layers when zlevel is not given
+    :return: integer array with the shape of Z with the number of active cells of each water column
+    """
+    H = np.where(Z > 0, np.asarray(Z, dtype=float) / 10, 0)
+    if zlevel is not None:
+        if isinstance(zlevel, str):
+            zlevel = np.loadtxt(zlevel, skiprows=4)[:, 1]
+        ztop = np.asarray(zlevel, dtype=float)
+        ztop = np.sort(ztop[ztop >= 0])
+        ncells = np.searchsorted(ztop, H, side='left')
+    elif dz is not None:
+        ncells = np.ceil(H / dz)
+    else:
+        raise ValueError('ERROR: either zlevel or dz must be given to count the active cells')
+    return np.where(H > 0, ncells, 0).astype(int)
+
+
+def _balancedBlocks(load, nparts):
+    """
+    Splits a 1-D load into nparts contiguous blocks with loads as close as possible to the mean load. Lines without
+    load are not counted, every block gets at least one line with load.
+    :return: (start indices of the blocks with len(load) appended, load of each block)
+    """
+    active = np.flatnonzero(load > 0)
+    m = len(active)
+    cload = np.concatenate(([0], np.cumsum(load[active])))
+    targets = cload[-1] * np.arange(1, nparts) / nparts
+    idx = np.clip(np.searchsorted(cload, targets), 1, m)
+    # move each cut to the closest side of its target
+    idx = np.where(targets - cload[idx - 1] < cload[idx] - targets, idx - 1, idx)
+    # cuts must be strictly increasing and leave at least one active line in each block
+    k = np.arange(nparts - 1)
+    idx = np.clip(np.maximum.accumulate(idx - k), 1, m - nparts + 1) + k
+    bounds = np.concatenate(([0], active[idx], [len(load)]))
+    return bounds, np.diff(cload[np.concatenate(([0], idx, [m]))])
+
+
+def _imbalance(blockLoad):
+    """Imbalance of a partition as max/mean - 1, 0 means perfectly balanced."""
+    mean = np.mean(blockLoad)
+    return np.max(blockLoad) / mean - 1 if mean > 0 else 0.0
+
+
+def partition4si3d(Z, nparts, zlevel=None, dz=None):
+    """
+    Proposes a load balanced partition of the grid rows and columns for parallel (psi3d) runs. The load of each row
+    and column is the number of active water column cells, so irregular basins are split in blocks with the same
+    amount of work rather than the same number of rows.
+    :param Z: bathymetry array as returned by bathy4si3d or BathyFileMaker.dem_array
+    :param nparts: number of threads (OMP_NUM_THREADS) or ranks
+    :param zlevel: layer depths or path to si3d_layer.txt, see activeCells4si3d
+    :param dz: constant layer thickness in m, see activeCells4si3d
+    :return: dict with the per row/column loads, the block bounds (0-based row/column index of Z where each block
+             starts, with the number of rows/columns appended), the same blocks as (first, last) si3d indices as
+             numbered in the h file (j = ny+1 for the first row of Z down to 2, i = 2 for the first column up to nx+1),
+             the load of each block, the imbalance of the balanced and equal size partitions and the recommended
+             axis ('rows' or 'cols'). An axis with fewer wet rows/columns than nparts is left out.
+    """
+    ncells = activeCells4si3d(Z, zlevel, dz)
+    ny, nx = np.shape(ncells)
+    part = {'nparts': nparts, 'ncells': int(ncells.sum())}
+    for axis, name in ((1, 'rows'), (0, 'cols')):
+        load = ncells.sum(axis=axis)
+        nactive = int(np.count_nonzero(load))
+        if nactive < nparts:
+            print('   ' + name + ' not partitioned: ' + str(nactive) + ' wet ' + name + ' for ' + str(nparts) +
+                  ' blocks')
+            continue
+        bounds, blockLoad = _balancedBlocks(load, nparts)
+        if name == 'rows':
+            ranges = [(ny - b1 + 2, ny - b0 + 1) for b0, b1 in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        else:
+            ranges = [(b0 + 2, b1 + 1) for b0, b1 in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        equalBounds = np.linspace(0, len(load), nparts + 1).round().astype(int)
+        cload = np.concatenate(([0], np.cumsum(load)))
+        part[name] = {'load': load, 'bounds': bounds, 'ranges': ranges, 'blockLoad': blockLoad,
+                      'imbalance': _imbalance(blockLoad), 'equalImbalance': _imbalance(np.diff(cload[equalBounds]))}
+    axes = [name for name in ('rows', 'cols') if name in part]
+    if not axes:
+        raise ValueError('ERROR: ' + str(nparts) + ' blocks requested but the grid only has ' +
+                         str(int(np.count_nonzero(ncells.sum(axis=1)))) + ' wet rows and ' +
+                         str(int(np.count_nonzero(ncells.sum(axis=0)))) + ' wet columns')
+    part['axis'] = min(axes, key=lambda name: part[name]['imbalance'])
+    print('Active cells: ' + str(part['ncells']) + ', partition in ' + str(nparts) + ' blocks')
+    for name in axes:
+        print('   %-4s imbalance: balanced %6.1f %%, equal blocks %6.1f %%' % (
+            name, 100 * part[name]['imbalance'], 100 * part[name]['equalImbalance']))
+    print('   Recommended: split ' + part['axis'] + ' (' + ('j' if part['axis'] == 'rows' else 'i') + ') in ' +
+          ' '.join('%d:%d' % r for r in sorted(part[part['axis']]['ranges'])))
+    return part
+
+
+def jobScript4si3d(JobName, PathSave, nparts=None, partition=None, filename='run.sh'):
+    """
+    Writes the SLURM job script that launches psi3d. If a partition from partition4si3d is given, the recommended
+    blocks (as si3d i or j index ranges) and the expected imbalance are written into the script.
+    :param JobName: name of the job
+    :param PathSave: folder where the script is saved, file path, or writable file-like object or bytearray
+                     (see openOutput)
+    :param nparts: number of threads, default is the number of tasks given to the queue ($SLURM_NTASKS)
+    :param partition: (optional) dict returned by partition4si3d
+    :param filename: name of the job script
+    :return: name of the job script output
+    """
+    if partition is not None and nparts is None:
+        nparts = partition['nparts']
+    lines = ['#!/bin/bash -l',
+             '# NOTE the -l flag!',
+             '',
+             '# Name of the job ',
+             '#SBATCH -J ' + JobName,
+             '# Standard out and Standard Error output files with the job number in the name.',
+             '#SBATCH -o ' + JobName + '-%j-%j.output',
+             '#SBATCH -e ' + JobName + '-%j.output']
+    if nparts is None:
+        lines += ['', '# no -n here, the user is expected to provide that on the command line.']
+    else:
+        lines += ['#SBATCH -n ' + str(nparts)]
+    if partition is not None:
+        axis = partition['axis']
+        blocks = partition[axis]
+        # blocks in increasing si3d index order
+        blockRanges = sorted(zip(blocks['blockLoad'].tolist(), blocks['ranges']), key=lambda b: b[1])
+        if axis == 'rows':
+            index, numbering = 'j', 'j = ny+1 for the first row of the bathymetry array down to 2 for the last row'
+        else:
+            index, numbering = 'i', 'i = 2 for the first column of the bathymetry array up to nx+1 for the last column'
+        lines += ['',
+                  '# Load balanced partition (partition4si3d) for ' + str(partition['nparts']) + ' threads, ' +
+                  str(partition['ncells']) + ' active cells',
+                  '#   split ' + axis + ' in blocks of si3d ' + index + ' indices (first:last) as numbered in the h '
+                  'file,',
+                  '#   ' + numbering,
+                  '#   active cells per block: ' + ' '.join(str(b) for b, _ in blockRanges),
+                  '#   expected imbalance: %.1f %% (equal size blocks: %.1f %%)' % (
+                      100 * blocks['imbalance'], 100 * blocks['equalImbalance']),
+                  'export SI3D_PARTITION_AXIS=' + index,
+                  'export SI3D_PARTITION_RANGES="' + ' '.join('%d:%d' % r for _, r in blockRanges) + '"']
+    lines += ['',
+              '# The useful part of your job goes below',
+              '',
+              '# run one thread for each one the user asks the queue for',
+              '# hostname is just for debugging',
+              'hostname',
+              'export OMP_NUM_THREADS=$SLURM_NTASKS',
+              'module load benchmarks intel',
+              '',
+              '# The main job executable to run: note the use of srun before it',
+              'time srun psi3d']
+    with openOutput(PathSave, filename, newline='\n') as fid:
+        fid.write('\n'.join(lines) + '\n')
+    print('The job script was saved as ' + outputName(PathSave, filename))
+    return outputName(PathSave, filename)
+
+
 def HeatBudget(HeatBudgetMethod, eta, Hswn, Hlwin, Hlwout, Ta, Pa, RH, Cl, cw, u, v, WaTemp, cChapra, esMethod):
     if HeatBudgetMethod == 'Chapra1995':
         rho0 = 997
@@ -657,3 +1288,155 @@ def HeatBudget(HeatBudgetMethod, eta, Hswn, Hlwin, Hlwout, Ta, Pa, RH, Cl, cw, u
         print('The file has not been created')
         exit()
     return Hswn, Hlwn, Hl, Hs, Hn
+
+
+def ensemblePerturb4si3d(base, nMembers, perturbations, seed=None, control=True):
+    """
+    Creates an ensemble of forcing series by perturbing a base record. All members are generated at once as
+    members x time arrays and the same seed always gives the same ensemble.
+    :param base: dict with the base series (1-D arrays of the same length), e.g. {'u': u, 'v': v, 'cw': cw,
+                 'Ta': Ta, 'Hswn': Hswn, ...}. Series without perturbation are repeated for every member.
+    :param nMembers: number of members
+    :param perturbations: dict mapping the names of the perturbed series to a dict with
+                          'type': 'additive' (x + sigma*e) or 'multiplicative' (x*(1 + sigma*e)),
+                          'sigma': standard deviation of the perturbation,
+                          'phi': (optional) lag-1 autocorrelation of e, AR(1) time-correlated noise (default 0, white
+                          noise, -1 < phi < 1), e.g. phi = exp(-dt/tau) for a correlation time tau,
+                          'min', 'max': (optional) bounds of the perturbed series (e.g. 'min': 0 for Hswn)
+    :param seed: seed of the random generator
+    :param control: if True member 0 is the unperturbed base record
+    :return: dict with the same keys as base with nMembers x time arrays
+    """
+    rng = np.random.default_rng(seed)
+    nt = len(next(iter(base.values())))
+    members = {}
+    for name in base:
+        x = np.asarray(base[name], dtype=float)
+        if len(x) != nt:
+            raise ValueError('ERROR: the base series ' + name + ' has ' + str(len(x)) + ' values instead of ' + str(nt))
+        members[name] = np.repeat(x[np.newaxis, :], nMembers, axis=0)
+    # draw in a fixed order so the ensemble does not depend on the order of the dict
+    for name in sorted(perturbations):
+        if name not in base:
+            raise KeyError('Perturbed series ' + name + ' is not in the base record')
+        p = perturbations[name]
+        phi = p.get('phi', 0)
+        if not -1 < phi < 1:
+            # |phi| >= 1 is not a stationary AR(1) process (sqrt of a negative number or a random walk)
+            raise ValueError('ERROR: phi of ' + name + ' must be between -1 and 1, not ' + str(phi))
+        e = rng.standard_normal((nMembers, nt))
+        if phi != 0:
+            # AR(1) e_t = phi*e_(t-1) + sqrt(1 - phi^2)*n_t, started from its stationary distribution
+            e[:, 0] /= np.sqrt(1 - phi ** 2)
+            e = signal.lfilter([np.sqrt(1 - phi ** 2)], [1, -phi], e, axis=1)
+        if p['type'] == 'additive':
+            x = members[name] + p['sigma'] * e
+        elif p['type'] == 'multiplicative':
+            x = members[name] * (1 + p['sigma'] * e)
+        else:
+            raise ValueError("ERROR: perturbation type must be 'additive' or 'multiplicative', not " + str(p['type']))
+        if 'min' in p or 'max' in p:
+            x = np.clip(x, p.get('min'), p.get('max'))
+        if control:
+            x[0] = members[name][0]
+        members[name] = x
+    return members
+
+
+def _surfbcBody(format, data, Pa=None):
+    """
+    Formats all the rows of a surfbc file in a single call.
+    :param format: row format
+    :param data: time x columns array
+    :param Pa: (optional) atmospheric pressure of each row, rows with Pa >= 100000 use SURFBC_RUNTIME_HIGHPA_FMT
+    :return: str
+    """
+    if Pa is None:
+        rowFormat = format * len(data)
+    else:
+        rowFormat = ''.join(np.where(np.asarray(Pa) >= 100000, SURFBC_RUNTIME_HIGHPA_FMT, format).tolist())
+    return rowFormat % tuple(data.ravel().tolist())
+
+
+def _writeSurfbcMember(target, filename, text):
+    """Writes the file of one ensemble member."""
+    with openOutput(target, filename) as fid:
+        fid.write(text)
+    return outputName(target, filename)
+
+
+def ensembleSurfbc4si3d(LakeName, surfbcType, days, hr, mins, year, dt, PathSave, members,
+                        HeatBudgetMethod='Chapra1995', cChapra=None, esMethod=1, filename='surfbc_%03d.txt', nJobs=None):
+    """
+    Writes one surface boundary condition file per ensemble member. The files are the same as the ones written by
+    surfbc4si3d for each member, but derived terms are computed for all the members in one call and the files are
+    written in parallel.
+    :param LakeName, surfbcType, days, hr, mins, year, dt: as in surfbc4si3d
+    :param PathSave: existing folder where the files are saved (named filename % member), or list with one output per
+                     member (file paths or writable file-like objects, see openOutput)
+    :param members: dict of members x time arrays as returned by ensemblePerturb4si3d, 1-D series are shared by
+                    all the members. Needed keys are
+                    eta, Hswn, Ta, Pa, RH (%), Cl, cw, u, v for RunTime1 (Hlwin instead of Cl for RunTime2) and
+                    eta, Hswn, Hn, cw, u, v for Preprocess. For Preprocess, Hn is computed with HeatBudget when not
+                    given, which needs Hlwin, Hlwout, Ta, Pa, RH (%), Cl, WaTemp as well.
+    :param HeatBudgetMethod: heat budget method used to compute Hn (Preprocess only)
+    :param cChapra: Bowen coefficient of the Chapra1995 method, needed when Hn is computed (Preprocess only)
+    :param esMethod: vapor pressure method of HeatBudget (Preprocess only)
+    :param filename: name pattern of the member files when PathSave is a folder
+    :param nJobs: number of files written at the same time (default: ThreadPoolExecutor default). The rows are
+                  formatted in the calling thread while the previous members are written.
+    :return: (list with the name of each member file, dict of the members x time columns written)
+    """
+    sizes = {np.shape(x)[0] for x in members.values() if np.ndim(x) == 2}
+    if len(sizes) != 1:
+        raise ValueError('ERROR: the members x time series must all have the same number of members, found ' +
+                         str(sorted(sizes)))
+    nMembers = sizes.pop()
+    if surfbcType == 'Preprocess':
+        order = ['eta', 'Hswn', 'Hn', 'cw', 'u', 'v']
+        if 'Hn' not in members:
+            if HeatBudgetMethod == 'Chapra1995' and cChapra is None:
+                raise ValueError('ERROR: cChapra must be given to compute Hn with the Chapra1995 heat budget')
+            m = members
+            _, _, _, _, Hn = HeatBudget(HeatBudgetMethod, m['eta'], m['Hswn'], m['Hlwin'], m['Hlwout'], m['Ta'],
+                                        m['Pa'], m['RH'] / 100, m['Cl'], m['cw'], m['u'], m['v'], m['WaTemp'],
+                                        cChapra, esMethod)
+            members = dict(members, Hn=Hn)
+    elif surfbcType == 'RunTime1':
+        order = ['eta', 'Hswn', 'Ta', 'Pa', 'RH', 'Cl', 'cw', 'u', 'v']
+    elif surfbcType == 'RunTime2':
+        order = ['eta', 'Hswn', 'Ta', 'Pa', 'RH', 'Hlwin', 'cw', 'u', 'v']
+    else:
+        raise ValueError('ERROR: surfbcType must be Preprocess, RunTime1 or RunTime2, not ' + str(surfbcType))
+    missing = [key for key in order if key not in members]
+    if missing:
+        raise KeyError('Missing ensemble series: ' + ', '.join(missing))
+
+    r = len(days)
+    Time = (np.asarray(days, dtype=float) - days[0]) * 24
+    columns = {key: np.broadcast_to(members[key], (nMembers, r)) for key in order}
+    if surfbcType != 'Preprocess':
+        columns['RH'] = columns['RH'] / 100
+    # members x time x columns
+    data = np.stack([np.broadcast_to(Time, (nMembers, r))] + [columns[key] for key in order], axis=2)
+    header = surfbcHeader(LakeName, surfbcType, days, hr, mins, year, dt, r,
+                          HeatBudgetMethod if surfbcType == 'Preprocess' else '')
+    format = SURFBC_PREPROCESS_FMT if surfbcType == 'Preprocess' else SURFBC_RUNTIME_FMT
+
+    if isinstance(PathSave, (str, os.PathLike)):
+        if not os.path.isdir(PathSave):
+            raise ValueError('ERROR: PathSave must be an existing folder or a list with one output per member, not ' +
+                             os.fspath(PathSave))
+        targets = [PathSave] * nMembers
+    else:
+        targets = list(PathSave)
+        if len(targets) != nMembers:
+            raise ValueError('ERROR: ' + str(len(targets)) + ' outputs were given for ' + str(nMembers) + ' members')
+    with ThreadPoolExecutor(max_workers=nJobs) as pool:
+        jobs = []
+        for m in range(nMembers):
+            body = _surfbcBody(format, data[m], None if surfbcType == 'Preprocess' else columns['Pa'][m])
+            jobs.append(pool.submit(_writeSurfbcMember, targets[m], filename % m, header + body))
+        names = [job.result() for job in jobs]
+    print(str(nMembers) + ' surfbc files written for the ensemble of ' + LakeName)
+    return names, columns